@@ -2,9 +2,15 @@
 #
 # The agent is a Python script that runs inside the jail as a long-lived
 # process, maintaining interpreter state across executions.
+#
+# orjson speeds up protocol (de)serialization; the agent falls back to
+# the stdlib json module if it is unavailable.
 { pkgs }:
 
+let
+  python = pkgs.python3.withPackages (ps: [ ps.orjson ]);
+in
 pkgs.writeScriptBin "sandbox-agent" ''
-  #!${pkgs.python3}/bin/python3
+  #!${python}/bin/python3
   ${builtins.readFile ./sandbox_agent.py}
 ''
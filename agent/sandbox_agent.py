@@ -13,13 +13,39 @@ user code from corrupting the protocol stream.
 """
 
 import io
+import itertools
 import json
 import os
 import secrets
+import select
+import selectors
 import struct
-import subprocess
 import sys
-from contextlib import redirect_stderr, redirect_stdout
+import traceback
+from abc import ABC, abstractmethod
+from collections import deque
+from functools import lru_cache
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj)  # returns UTF-8 bytes directly
+        except orjson.JSONEncodeError:
+            # orjson rejects lone surrogates and ints wider than 64 bits;
+            # the stdlib escapes or writes them as the baseline agent did
+            return json.dumps(obj).encode()
+
+except ImportError:  # stdlib fallback when running outside the Nix build
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    def _loads(data):
+        return json.loads(bytes(data))  # json.loads rejects memoryview
 
 # ─────────────────────────────────────────────────────────────────
 # Protocol I/O — uses saved real file descriptors
@@ -28,35 +54,117 @@ from contextlib import redirect_stderr, redirect_stdout
 # Save real stdin/stdout BEFORE any user code can touch them
 REAL_STDIN = sys.stdin.buffer
 REAL_STDOUT = sys.stdout.buffer
+_IN_FD = REAL_STDIN.fileno()
+_OUT_FD = REAL_STDOUT.fileno()
 
 # Redirect sys.stdout/stderr so user print() can't corrupt protocol
 sys.stdout = open(os.devnull, "w")
 sys.stderr = open("/workspace/.agent.log", "a")
 
+# Frame header: 4-byte big-endian payload length (format compiled once)
+_HDR = struct.Struct(">I")
+_HDR_SIZE = _HDR.size
+
+
+def _frame(payload: bytes) -> bytes:
+    """Prefix a payload with its length header."""
+    return _HDR.pack(len(payload)) + payload
+
+
+# Frames waiting for flush_messages(); the main loop flushes before it
+# blocks, so responses produced together leave in one writev
+_outbox: list[bytes] = []
+
+
+def send_raw(frame: bytes) -> None:
+    """Queue an already-framed message for real stdout."""
+    _outbox.append(frame)
+
 
 def send_message(msg: dict) -> None:
-    """Send a length-prefixed JSON message on real stdout."""
-    payload = json.dumps(msg).encode()
-    REAL_STDOUT.write(struct.pack(">I", len(payload)))
-    REAL_STDOUT.write(payload)
-    REAL_STDOUT.flush()
+    """Queue a length-prefixed JSON message for real stdout."""
+    _outbox.append(_frame(_dumps(msg)))
+
+
+def flush_messages() -> None:
+    """Write all queued frames directly to the real stdout fd.
+
+    Bypasses the BufferedWriter: frames are already whole, so its buffer
+    and flush only add copies. The agent is single-threaded, so frames
+    can't interleave.
+    """
+    while _outbox:
+        written = os.writev(_OUT_FD, _outbox)
+        # Drop fully written frames; keep the unwritten tail of a partial one
+        while written:
+            size = len(_outbox[0])
+            if written < size:
+                _outbox[0] = memoryview(_outbox[0])[written:]
+                break
+            written -= size
+            del _outbox[0]
+
+
+# Fixed-shape messages, serialized once at import
+_READY_FRAME = _frame(_dumps({"type": "ready"}))
+_PONG_FRAME = _frame(_dumps({"type": "pong"}))
 
 
 MAX_MESSAGE_SIZE = 64 * 1024 * 1024  # 64 MB, matches Rust transport limit
 
+# Receive buffer reused across messages, grown on demand up to
+# RECV_BUF_LIMIT. Rare larger messages (e.g. a bundled script) get a
+# one-off buffer instead, so one of them doesn't pin tens of MB of
+# memory for the rest of the session.
+RECV_BUF_LIMIT = 1024 * 1024
+_recv_buf = bytearray(65536)
+_recv_view = memoryview(_recv_buf)
+
+
+def _recv_exact(n: int) -> memoryview:
+    """Read n bytes from real stdin, returning a view of what arrived.
+
+    Pipes can return short reads, so loop until n bytes arrive or stdin
+    hits EOF; on EOF the returned view is shorter than n.
+    """
+    global _recv_buf, _recv_view
+    if n <= len(_recv_buf):
+        view = _recv_view
+    elif n <= RECV_BUF_LIMIT:
+        _recv_buf = bytearray(n)
+        _recv_view = view = memoryview(_recv_buf)
+    else:
+        view = memoryview(bytearray(n))
+    got = 0
+    while got < n:
+        count = os.readv(_IN_FD, [view[got:n]])
+        if count == 0:
+            break
+        got += count
+    return view[:got]
+
+
+_STDIN_POLL = select.poll()
+_STDIN_POLL.register(_IN_FD, select.POLLIN)
+
+
+def stdin_ready() -> bool:
+    """Whether a read from real stdin would return without blocking."""
+    return bool(_STDIN_POLL.poll(0))
+
 
 def recv_message() -> dict:
     """Read a length-prefixed JSON message from real stdin."""
-    raw_len = REAL_STDIN.read(4)
-    if len(raw_len) < 4:
+    header = _recv_exact(_HDR_SIZE)
+    if len(header) < _HDR_SIZE:
         raise EOFError("stdin closed")
-    (length,) = struct.unpack(">I", raw_len)
+    (length,) = _HDR.unpack(header)
     if length > MAX_MESSAGE_SIZE:
         raise ValueError(f"message too large: {length} bytes (max {MAX_MESSAGE_SIZE})")
-    payload = REAL_STDIN.read(length)
+    payload = _recv_exact(length)
     if len(payload) < length:
         raise EOFError("incomplete message")
-    return json.loads(payload)
+    return _loads(payload)
 
 
 # ─────────────────────────────────────────────────────────────────
@@ -64,6 +172,23 @@ def recv_message() -> dict:
 # ─────────────────────────────────────────────────────────────────
 
 
+# Longest source kept in the compile cache. The cache holds its keys for
+# the whole session, so large one-off scripts are compiled uncached.
+COMPILE_CACHE_MAX_SOURCE = 4096
+
+
+@lru_cache(maxsize=512)
+def _compile_cached(code: str):
+    """Compile a snippet once; clients often resend identical setup code."""
+    return compile(code, "<string>", "exec")
+
+
+def _compile(code: str):
+    if len(code) > COMPILE_CACHE_MAX_SOURCE:
+        return compile(code, "<string>", "exec")
+    return _compile_cached(code)
+
+
 class PythonInterpreter:
     """Persistent Python interpreter using exec() with a single shared namespace.
 
@@ -75,176 +200,349 @@ class PythonInterpreter:
 
     def __init__(self):
         self.namespace = {"__builtins__": __builtins__}
+        self._out_buf, self._out_text = self._capture_stream()
+        self._err_buf, self._err_text = self._capture_stream()
+
+    @staticmethod
+    def _capture_stream() -> tuple[io.BytesIO, io.TextIOWrapper]:
+        """Build a reusable text stream that writes straight through to bytes."""
+        buf = io.BytesIO()
+        text = io.TextIOWrapper(
+            buf, encoding="utf-8", errors="backslashreplace", write_through=True
+        )
+        return buf, text
+
+    @staticmethod
+    def _usable(text: io.TextIOWrapper) -> bool:
+        """Whether a capture stream survived the previous run's user code."""
+        try:
+            return not text.closed
+        except ValueError:  # detached from its buffer
+            return False
 
     def execute(self, code: str) -> tuple[str, str, int]:
         """Execute code, returning (stdout, stderr, exit_code)."""
-        buf_out = io.StringIO()
-        buf_err = io.StringIO()
+        # User code may have closed or detached the capture streams on a
+        # previous run
+        if not self._usable(self._out_text):
+            self._out_buf, self._out_text = self._capture_stream()
+        if not self._usable(self._err_text):
+            self._err_buf, self._err_text = self._capture_stream()
+        for buf in (self._out_buf, self._err_buf):
+            buf.seek(0)
+            buf.truncate(0)
+
+        saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self._out_text, self._err_text
         try:
-            with redirect_stdout(buf_out), redirect_stderr(buf_err):
-                exec(code, self.namespace)  # single dict = globals IS locals
-            return buf_out.getvalue(), buf_err.getvalue(), 0
+            exec(_compile(code), self.namespace)  # single dict = globals IS locals
+            exit_code, tb = 0, ""
         except SystemExit as e:
-            return (
-                buf_out.getvalue(),
-                buf_err.getvalue(),
-                e.code if isinstance(e.code, int) else 1,
-            )
+            exit_code, tb = (e.code if isinstance(e.code, int) else 1), ""
         except Exception:
-            import traceback
+            exit_code, tb = 1, traceback.format_exc()
+        finally:
+            sys.stdout, sys.stderr = saved
+        return (
+            self._out_buf.getvalue().decode(errors="replace"),
+            self._err_buf.getvalue().decode(errors="replace") + tb,
+            exit_code,
+        )
 
-            tb = traceback.format_exc()
-            return buf_out.getvalue(), buf_err.getvalue() + tb, 1
 
+READ_CHUNK_SIZE = 65536
 
-class BashInterpreter:
-    """Persistent bash process with per-execution nonce markers."""
+# Per-execution marker nonces: a random per-process base keeps them
+# unguessable, a counter keeps them unique without a urandom read each time
+_MARKER_BASE = secrets.token_hex(8)
+_MARKER_COUNTER = itertools.count()
+
+# Shared event loop selector: protocol stdin plus the stdout/stderr of
+# whichever subprocess interpreter is currently producing output
+_SELECTOR = selectors.DefaultSelector()
+
+
+def _read_until(fd: int, marker: bytes, buf: bytearray) -> bytes | None:
+    """Read from fd into buf until marker appears.
+
+    Returns the bytes before the marker and leaves anything after it in
+    buf for the next call (the subprocesses are persistent, so a read can
+    run past the end of the current execution). Returns None if the pipe
+    closes before the marker is seen.
+    """
+    start = 0
+    while True:
+        idx = buf.find(marker, start)
+        if idx >= 0:
+            data = bytes(buf[:idx])
+            del buf[: idx + len(marker)]
+            return data
+        # Marker may straddle chunk boundaries; rescan only the tail
+        start = max(0, len(buf) - len(marker) + 1)
+        chunk = os.read(fd, READ_CHUNK_SIZE)
+        if not chunk:
+            return None
+        buf.extend(chunk)
+
+
+class _SubprocessInterpreter(ABC):
+    """Persistent child process whose output is delimited by nonce markers.
+
+    start() sends the wrapped code and registers the child's stdout and
+    stderr with the shared selector. The main loop hands each readable fd
+    to poll(), which returns the result once both markers have been seen.
+    Draining both streams as they become ready keeps a chatty stream from
+    filling its pipe and blocking the child while we wait on the other.
+
+    After running the code, the child must write "<stdout marker>
+    <exit code>\\n" to stdout and "<stderr marker>\\n" to stderr.
+    Subclasses provide NAME, ARGS and _wrap().
+    """
+
+    NAME: str
+    ARGS: list[str]
 
     def __init__(self):
+        # Imported here, not at module level: sessions that only run Python
+        # never need it, and it is one of the agent's slower imports
+        import subprocess
+
         self.proc = subprocess.Popen(
-            ["bash", "--norc", "--noprofile"],
+            self.ARGS,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-
-    def execute(self, code: str) -> tuple[str, str, int]:
-        """Execute code, returning (stdout, stderr, exit_code)."""
-        nonce = secrets.token_hex(16)
-        stdout_marker = f"__STDOUT_DONE_{nonce}__"
-        stderr_marker = f"__STDERR_DONE_{nonce}__"
-
-        # Wrap code: run it, capture exit code, emit markers with exit code
-        wrapped = (
-            f"{code}\n"
-            f"__exit_code__=$?\n"
-            f"echo {stdout_marker} $__exit_code__\n"
-            f"echo {stderr_marker} >&2\n"
-        )
-
-        self.proc.stdin.write(wrapped.encode())
+        self._stdout_fd = self.proc.stdout.fileno()
+        self._stderr_fd = self.proc.stderr.fileno()
+        # Bytes read past a marker stay buffered for the next execution
+        self._bufs = {self._stdout_fd: bytearray(), self._stderr_fd: bytearray()}
+        self._markers = {}  # fd -> marker still awaited
+        self._output = {}  # fd -> bytes before the marker, or None on EOF
+
+    @abstractmethod
+    def _wrap(self, code: bytes, stdout_marker: bytes, stderr_marker: bytes) -> bytes:
+        """Build the bytes sent to the child's stdin for one execution."""
+
+    def start(self, code: str) -> None:
+        """Send code to the child; the result arrives through poll()."""
+        nonce = f"{_MARKER_BASE}{next(_MARKER_COUNTER):x}".encode()
+        stdout_marker = b"__STDOUT_DONE_" + nonce + b"__"
+        stderr_marker = b"__STDERR_DONE_" + nonce + b"__"
+
+        self.proc.stdin.write(self._wrap(code.encode(), stdout_marker, stderr_marker))
         self.proc.stdin.flush()
 
-        # Read stdout until marker
-        stdout_lines = []
-        exit_code = 0
-        for line in iter(self.proc.stdout.readline, b""):
-            decoded = line.decode(errors="replace")
-            if stdout_marker in decoded:
-                # Parse exit code from marker line
-                parts = decoded.strip().split()
-                if len(parts) >= 2:
-                    try:
-                        exit_code = int(parts[-1])
-                    except ValueError:
-                        exit_code = 1
-                break
-            stdout_lines.append(decoded)
+        self._output = {}
+        self._markers = {
+            self._stdout_fd: stdout_marker + b" ",
+            self._stderr_fd: stderr_marker + b"\n",
+        }
+        for fd in self._markers:
+            _SELECTOR.register(fd, selectors.EVENT_READ, self)
+
+    def poll(self, fd: int) -> tuple[str, str, int] | None:
+        """Consume output ready on fd; return the result once it is complete."""
+        marker = self._markers[fd]
+        buf = self._bufs[fd]
+        chunk = os.read(fd, READ_CHUNK_SIZE)
+        if not chunk:
+            self._output[fd] = None
         else:
-            # readline returned b"" — pipe closed, process died
-            if self.proc.poll() is not None:
-                return "".join(stdout_lines), "bash process died unexpectedly", 1
-
-        # Read stderr until marker
-        stderr_lines = []
-        for line in iter(self.proc.stderr.readline, b""):
-            decoded = line.decode(errors="replace")
-            if stderr_marker in decoded:
-                break
-            stderr_lines.append(decoded)
+            # Marker may straddle chunk boundaries; rescan only the tail
+            start = max(0, len(buf) - len(marker) + 1)
+            buf.extend(chunk)
+            idx = buf.find(marker, start)
+            if idx < 0:
+                return None
+            self._output[fd] = bytes(buf[:idx])
+            del buf[: idx + len(marker)]
+        _SELECTOR.unregister(fd)
+        del self._markers[fd]
+        if self._markers:
+            return None
+        return self._result(self._output[self._stdout_fd], self._output[self._stderr_fd])
+
+    def _take_partial(self, fd: int) -> bytes:
+        """Return and clear whatever was buffered for a stream that hit EOF."""
+        data = bytes(self._bufs[fd])
+        self._bufs[fd].clear()
+        return data
+
+    def _result(self, stdout: bytes | None, stderr: bytes | None) -> tuple[str, str, int]:
+        # The stdout marker line carries the exit code. It was written
+        # before the stderr marker, so reading the rest of it can't block.
+        status = None
+        if stdout is not None:
+            status = _read_until(self._stdout_fd, b"\n", self._bufs[self._stdout_fd])
+        if status is None:
+            # Pipe closed before the marker — process died
+            partial = self._take_partial(self._stdout_fd) if stdout is None else stdout
+            return partial.decode(errors="replace"), f"{self.NAME} process died unexpectedly", 1
+        try:
+            exit_code = int(status)
+        except ValueError:
+            exit_code = 1
 
-        return "".join(stdout_lines), "".join(stderr_lines), exit_code
+        if stderr is None:
+            stderr = self._take_partial(self._stderr_fd)
+
+        return stdout.decode(errors="replace"), stderr.decode(errors="replace"), exit_code
+
+    def unwatch(self) -> None:
+        """Stop waiting on the current execution's output."""
+        for fd in self._markers:
+            _SELECTOR.unregister(fd)
+        self._markers = {}
 
     def close(self):
+        self.unwatch()
         if self.proc.poll() is None:
             self.proc.stdin.close()
             self.proc.terminate()
             self.proc.wait(timeout=5)
 
 
-class NodeInterpreter:
-    """Persistent Node.js REPL with custom config for clean output.
-
-    Uses require('repl').start() with:
-    - prompt: ''           — no "> " noise
-    - ignoreUndefined      — suppress undefined echo
-    - writer: () => ''     — suppress all result echo
-    - output → stderr      — REPL chrome goes to stderr, not stdout
-    - No try/catch wrap    — let/const persist in REPL top-level scope
-    """
+class BashInterpreter(_SubprocessInterpreter):
+    """Persistent bash process with per-execution nonce markers."""
 
-    REPL_SETUP = (
-        "const _r=require('repl').start({"
-        "input:process.stdin,"
-        "prompt:'',"
-        "ignoreUndefined:true,"
-        "writer:()=>'',"
-        "output:new(require('stream').Writable)("
-        "{write(c,e,cb){process.stderr.write(c,e,cb)}})"
-        "});"
-        "_r.context.console=new(require('console').Console)"
-        "(process.stdout,process.stderr);\n"
+    NAME = "bash"
+    ARGS = ["bash", "--norc", "--noprofile"]
+    # Run the code, capture its exit code, then echo each marker
+    # (stdout's followed by the exit code)
+    EPILOGUE = (
+        b"\n__exit_code__=$?\necho ",
+        b" $__exit_code__\necho ",
+        b" >&2\n",
     )
-    REPL_SETUP_PATH = os.path.join(os.environ.get("TMPDIR", "/tmp"), "_node_repl_setup.js")
-
-    def __init__(self):
-        # Write setup to file so process.stdin is a proper stream
-        # (node -e doesn't fully initialize stdin as a readable stream)
-        with open(self.REPL_SETUP_PATH, "w") as f:
-            f.write(self.REPL_SETUP)
-        self.proc = subprocess.Popen(
-            ["node", self.REPL_SETUP_PATH],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
 
-    def execute(self, code: str) -> tuple[str, str, int]:
-        """Execute code, returning (stdout, stderr, exit_code)."""
-        nonce = secrets.token_hex(16)
-        stdout_marker = f"__STDOUT_DONE_{nonce}__"
-        stderr_marker = f"__STDERR_DONE_{nonce}__"
-
-        # Send code directly (no try/catch — preserves let/const scope)
-        # .break cancels any pending multiline input mode
-        wrapped = (
-            f"{code}\n"
-            f".break\n"
-            f"process.stdout.write('{stdout_marker}\\n');\n"
-            f"process.stderr.write('{stderr_marker}\\n');\n"
-        )
+    def _wrap(self, code: bytes, stdout_marker: bytes, stderr_marker: bytes) -> bytes:
+        pre, mid, end = self.EPILOGUE
+        return b"".join((code, pre, stdout_marker, mid, stderr_marker, end))
 
-        self.proc.stdin.write(wrapped.encode())
-        self.proc.stdin.flush()
 
-        stdout_lines = []
-        for line in iter(self.proc.stdout.readline, b""):
-            decoded = line.decode(errors="replace")
-            if stdout_marker in decoded:
-                break
-            stdout_lines.append(decoded)
-        else:
-            if self.proc.poll() is not None:
-                return "".join(stdout_lines), "node process died unexpectedly", 1
+class NodeInterpreter(_SubprocessInterpreter):
+    """Persistent Node.js process running a small evaluation driver.
 
-        stderr_lines = []
-        for line in iter(self.proc.stderr.readline, b""):
-            decoded = line.decode(errors="replace")
-            if stderr_marker in decoded:
-                break
-            if decoded.strip():  # Skip empty lines from REPL writer
-                stderr_lines.append(decoded)
+    The driver reads length-prefixed requests from stdin and evaluates
+    each with vm.runInThisContext, so top-level let/const/var persist
+    across executions. It writes the markers and exit code itself:
+    nothing to strip from the output, and no REPL prompt, echo or
+    multiline-input state to work around. Like the REPL, it exposes
+    require and the core modules as globals, rewrites top-level await
+    the same way (so its declarations persist too), and reports uncaught
+    errors on stderr as "Uncaught ...".
+    """
 
-        stdout = "".join(stdout_lines)
-        stderr = "".join(stderr_lines)
-        exit_code = 1 if "Uncaught" in stderr else 0
-        return stdout, stderr, exit_code
+    NAME = "node"
+    # Request framing: "<code length> <stdout marker> <stderr marker>\n<code>"
+    DRIVER = r"""
+(() => {
+  const util = require('util');
+  const vm = require('vm');
+  // The REPL's own top-level await rewrite (needs --expose-internals):
+  // it hoists top-level declarations out of the async wrapper it adds
+  const { processTopLevelAwait } = require('internal/repl/await');
+  globalThis.require = require;
+  for (const name of require('module').builtinModules) {
+    if (name.startsWith('_') || name.includes('/') || name in globalThis) continue;
+    Object.defineProperty(globalThis, name, {
+      configurable: true,
+      get() { return require(name); },
+      set(value) {
+        Object.defineProperty(globalThis, name, { configurable: true, writable: true, value });
+      },
+    });
+  }
+  const describe = (err) => {
+    // Thrown values can have inspect hooks or toString methods that throw
+    try { return util.inspect(err); } catch {}
+    try { return String(err); } catch {}
+    return '<uninspectable value>';
+  };
+  const report = (err) => {
+    let text = describe(err);
+    // Drop the driver's own frames below the evaluated code
+    const cut = text.search(/\n {4}at .*\(node:vm:/);
+    if (cut >= 0) text = text.slice(0, cut);
+    process.stderr.write('Uncaught ' + text + '\n');
+  };
+  // Errors thrown later from timers or promises must not kill the driver
+  process.on('uncaughtException', report);
+  process.on('unhandledRejection', report);
+
+  const evaluate = async (code) => {
+    const options = { filename: 'repl', displayErrors: false };
+    // Like the REPL, try the rewrite first: `await (f)()` also parses as
+    // a sloppy-mode call to a function named await
+    let wrapped = null;
+    if (code.includes('await')) {
+      try {
+        wrapped = processTopLevelAwait(code);
+      } catch {
+        // Invalid code: compile it as-is to report the original error
+      }
+    }
+    if (wrapped === null) {
+      new vm.Script(code, options).runInThisContext(options);
+      return;
+    }
+    await new vm.Script(wrapped, options).runInThisContext(options);
+  };
+  const execute = async (code, stdoutMarker, stderrMarker) => {
+    let exitCode = 0;
+    try {
+      await evaluate(code);
+    } catch (err) {
+      exitCode = 1;
+      report(err);
+    } finally {
+      process.stdout.write(stdoutMarker + ' ' + exitCode + '\n');
+      process.stderr.write(stderrMarker + '\n');
+    }
+  };
+
+  // Chunks of the request being received are collected and joined once
+  // it is complete: joining on every read is quadratic in the code size
+  let header = null; // [code length, stdout marker, stderr marker]
+  let chunks = [];
+  let received = 0;
+  let queue = Promise.resolve();
+  process.stdin.on('data', (chunk) => {
+    for (;;) {
+      if (header === null) {
+        const eol = chunk.indexOf(10);
+        if (eol < 0) {
+          if (chunk.length) chunks.push(chunk);
+          return;
+        }
+        chunks.push(chunk.subarray(0, eol));
+        const [len, stdoutMarker, stderrMarker] = Buffer.concat(chunks).toString('latin1').split(' ');
+        header = [Number(len), stdoutMarker, stderrMarker];
+        chunks = [];
+        received = 0;
+        chunk = chunk.subarray(eol + 1);
+      }
+      const [len, stdoutMarker, stderrMarker] = header;
+      const take = Math.min(len - received, chunk.length);
+      if (take > 0) chunks.push(chunk.subarray(0, take));
+      received += take;
+      chunk = chunk.subarray(take);
+      if (received < len) return;
+      const code = Buffer.concat(chunks, len).toString('utf8');
+      header = null;
+      chunks = [];
+      // One failed execution must not stall every later one in the queue
+      queue = queue.then(() => execute(code, stdoutMarker, stderrMarker)).catch(() => {});
+    }
+  });
+})();
+"""
+    ARGS = ["node", "--expose-internals", "-e", DRIVER]
 
-    def close(self):
-        if self.proc.poll() is None:
-            self.proc.stdin.close()
-            self.proc.terminate()
-            self.proc.wait(timeout=5)
+    def _wrap(self, code: bytes, stdout_marker: bytes, stderr_marker: bytes) -> bytes:
+        header = b"%d %s %s\n" % (len(code), stdout_marker, stderr_marker)
+        return header + code
 
 
 # ─────────────────────────────────────────────────────────────────
@@ -258,21 +556,41 @@ INTERPRETER_CLASSES = {
     "node": NodeInterpreter,
 }
 
-def dispatch_execute(interpreters: dict, interpreter_name: str, code: str) -> dict:
-    """Dispatch code execution to the appropriate interpreter.
 
-    Lazily creates interpreter instances on first use and caches them.
-    Returns a dict with stdout, stderr, exit_code.
-    """
-    if interpreter_name not in INTERPRETER_CLASSES:
-        valid = ", ".join(sorted(INTERPRETER_CLASSES))
-        return {"stdout": "", "stderr": f"Error: unknown interpreter '{interpreter_name}'. Valid: {valid}", "exit_code": 1}
-    # if valid, and not created, call the constructor
+def _get_interpreter(interpreters: dict, interpreter_name: str):
+    """Return the session's interpreter, creating it on first use."""
     if interpreter_name not in interpreters:
         interpreters[interpreter_name] = INTERPRETER_CLASSES[interpreter_name]()
+    return interpreters[interpreter_name]
+
 
-    stdout, stderr, exit_code = interpreters[interpreter_name].execute(code)
-    return {"stdout": stdout, "stderr": stderr, "exit_code": exit_code}
+def start_execute(
+    interpreters: dict, interpreter_name: str, code: str
+) -> _SubprocessInterpreter | None:
+    """Start code on a subprocess interpreter (bash, node).
+
+    Returns the interpreter; its result is delivered later through
+    poll() as the main loop sees its output. Returns None, starting
+    nothing, if interpreter_name isn't a subprocess interpreter.
+    """
+    cls = INTERPRETER_CLASSES.get(interpreter_name)
+    if cls is None or not issubclass(cls, _SubprocessInterpreter):
+        return None
+    interp = _get_interpreter(interpreters, interpreter_name)
+    interp.start(code)
+    return interp
+
+
+def dispatch_execute(interpreters: dict, interpreter_name: str, code: str) -> tuple[str, str, int]:
+    """Execute code on an in-process interpreter (Python).
+
+    Subprocess interpreters are run through start_execute() instead.
+    Returns (stdout, stderr, exit_code).
+    """
+    if interpreter_name not in INTERPRETER_CLASSES:
+        valid = ", ".join(sorted(INTERPRETER_CLASSES))
+        return "", f"Error: unknown interpreter '{interpreter_name}'. Valid: {valid}", 1
+    return _get_interpreter(interpreters, interpreter_name).execute(code)
 
 
 # ─────────────────────────────────────────────────────────────────
@@ -280,63 +598,159 @@ def dispatch_execute(interpreters: dict, interpreter_name: str, code: str) -> di
 # ─────────────────────────────────────────────────────────────────
 
 
-def main():
-    # Send Ready message
-    send_message({"type": "ready"})
+def send_result(req_id: str, stdout: str, stderr: str, exit_code: int) -> None:
+    try:
+        send_message(
+            {
+                "type": "result",
+                "id": req_id,
+                "stdout": stdout,
+                "stderr": stderr,
+                "exit_code": exit_code,
+            }
+        )
+    except Exception as e:
+        # e.g. orjson rejects an exit code wider than 64 bits
+        send_internal_error(e)
+
+
+def send_internal_error(e: Exception) -> None:
+    """Report an unexpected failure so the daemon doesn't hang."""
+    tb = traceback.format_exc()
+    # Log to agent log file for debugging
+    print(tb, file=sys.stderr)
+    send_message(
+        {
+            "type": "error",
+            "message": f"Agent internal error: {e}",
+        }
+    )
 
-    interpreters = {}
 
-    while True:
+# Most protocol messages handled per stdin wakeup before flushing
+MAX_BATCH = 32
+
+
+# Protocol message handlers: each takes the message and the execute
+# queue, and returns False once the agent should stop
+def handle_shutdown(msg: dict, queued: deque) -> bool:
+    return False
+
+
+def handle_ping(msg: dict, queued: deque) -> bool:
+    send_raw(_PONG_FRAME)
+    return True
+
+
+def handle_execute(msg: dict, queued: deque) -> bool:
+    queued.append(msg)
+    return True
+
+
+# Registry mapping message types to their handlers
+MESSAGE_HANDLERS = {
+    "shutdown": handle_shutdown,
+    "ping": handle_ping,
+    "execute": handle_execute,
+}
+
+
+def drain_messages(queued: deque) -> bool:
+    """Handle the protocol messages waiting on real stdin.
+
+    Reads up to MAX_BATCH messages while more are already buffered, so a
+    pipelined burst is answered by one flush instead of one write per
+    message. Execute requests are appended to `queued`; the rest are
+    answered straight away. Returns False once the agent should stop.
+    """
+    for _ in range(MAX_BATCH):
         try:
             msg = recv_message()
         except EOFError:
-            break
+            return False
         except (json.JSONDecodeError, ValueError) as e:
             send_message({"type": "error", "message": f"Bad message: {e}"})
-            continue
-
-        msg_type = msg.get("type")
+            msg = None
 
-        if msg_type == "shutdown":
-            break
-        elif msg_type == "ping":
-            send_message({"type": "pong"})
-        elif msg_type == "execute":
-            req_id = msg.get("id", "")
-            interpreter_name = msg.get("interpreter", "python")
-            code = msg.get("code", "")
-
-            try:
-                result = dispatch_execute(interpreters, interpreter_name, code)
+        if msg is not None:
+            msg_type = msg.get("type")
+            # Guard the lookup: a non-string type may be unhashable
+            handler = MESSAGE_HANDLERS.get(msg_type) if isinstance(msg_type, str) else None
+            if handler is None:
                 send_message(
                     {
-                        "type": "result",
-                        "id": req_id,
-                        "stdout": result["stdout"],
-                        "stderr": result["stderr"],
-                        "exit_code": result["exit_code"],
+                        "type": "error",
+                        "message": f"Unknown message type: {msg_type}",
                     }
                 )
+            elif not handler(msg, queued):
+                return False
+
+        if not stdin_ready():
+            break
+    return True
+
+
+def main():
+    # Send Ready message
+    send_raw(_READY_FRAME)
+
+    interpreters = {}
+    # Protocol messages are handled as they arrive, even while a bash or
+    # node execution is still producing output. Executions themselves run
+    # one at a time in arrival order; later ones wait in `queued`.
+    running = None  # (req_id, interpreter) of the in-flight execution
+    queued = deque()
+    _SELECTOR.register(_IN_FD, selectors.EVENT_READ)
+
+    while True:
+        while running is None and queued:
+            # Don't hold earlier responses back behind a long execution
+            flush_messages()
+            get = queued.popleft().get
+            req_id = get("id", "")
+            interpreter_name, code = get("interpreter", "python"), get("code", "")
+            try:
+                interp = start_execute(interpreters, interpreter_name, code)
+                if interp is not None:
+                    running = (req_id, interp)
+                else:
+                    send_result(req_id, *dispatch_execute(interpreters, interpreter_name, code))
             except Exception as e:
-                # Catch-all: send error response so daemon doesn't hang
-                import traceback
+                send_internal_error(e)
+
+        flush_messages()
+        stop = False
+        for key, _ in _SELECTOR.select():
+            if key.fd == _IN_FD:
+                if not drain_messages(queued):
+                    stop = True
+                    break
+                continue
+            # Only the in-flight execution's fds should be registered
+            if running is None or key.data is not running[1]:
+                continue
+            req_id, interp = running
+            try:
+                result = interp.poll(key.fd)
+            except Exception as e:
+                running = None
+                # Its output is now out of step with the markers, so the
+                # next execution gets a fresh process instead
+                interpreters = {n: i for n, i in interpreters.items() if i is not interp}
+                try:
+                    interp.close()
+                except Exception:
+                    pass
+                send_internal_error(e)
+                continue
+            if result is not None:
+                running = None
+                send_result(req_id, *result)
+        if stop:
+            break
 
-                tb = traceback.format_exc()
-                # Log to agent log file for debugging
-                print(tb, file=sys.stderr)
-                send_message(
-                    {
-                        "type": "error",
-                        "message": f"Agent internal error: {e}",
-                    }
-                )
-        else:
-            send_message(
-                {
-                    "type": "error",
-                    "message": f"Unknown message type: {msg_type}",
-                }
-            )
+    flush_messages()
 
     # Cleanup
     for interp in interpreters.values():
@@ -168,6 +168,29 @@ with subtest("Session state persists - Python"):
     assert "42" in resps.get(3, ""), f"Expected '42' from session state: {resps}"
 
 
+# Test 10b: Node session state, errors and core-module globals
+with subtest("Session state persists - Node"):
+    resps = mcp_session(
+        {"env": "node", "code": "let n = 21", "session": "nodetest1"},
+        {"env": "node", "code": "console.log(n * 2)", "session": "nodetest1"},
+        {"env": "node", "code": "throw new Error('node boom')", "session": "nodetest1"},
+        {"env": "node", "code": "console.log(fs.existsSync('/workspace'))", "session": "nodetest1"},
+        {"env": "node", "code": "const w = await Promise.resolve(7)", "session": "nodetest1"},
+        {"env": "node", "code": "console.log(w * 6)", "session": "nodetest1"},
+    )
+    # id:3 reads the let binding declared by id:2
+    assert "42" in resps.get(3, ""), f"Expected '42' from node session state: {resps}"
+    # id:4 throws: exit code 1 surfaces as isError, with the REPL-style prefix
+    thrown = json.loads(resps.get(4, "{}")).get("result", {})
+    assert thrown.get("isError") is True, f"Expected node throw to be an error: {resps}"
+    assert "Uncaught" in resps.get(4, "") and "node boom" in resps.get(4, ""), f"Expected 'Uncaught' error: {resps}"
+    # id:5 uses the fs core module without require()
+    fs_result = json.loads(resps.get(5, "{}")).get("result", {})
+    assert fs_result.get("content", [{}])[0].get("text", "").strip() == "true", f"Expected fs global to work: {resps}"
+    # id:7 reads a declaration made alongside top-level await in id:6
+    assert "42" in resps.get(7, ""), f"Expected top-level await declaration to persist: {resps}"
+
+
 # Test 11: Different sessions are isolated
 with subtest("Different sessions are isolated"):
     resps = mcp_session(